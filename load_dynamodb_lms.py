@@ -1,27 +1,42 @@
 
 import asyncio
-import contextlib
 import csv
 import datetime as dt
+import itertools
 import json
 import logging
+import operator
 import os
-import re
+import random
 import sys
 import time
 from argparse import ArgumentParser as Ap, Namespace
-from typing import Any
+from typing import Any, Iterator
 
 import aioboto3
-import aiofiles
 import boto3
-from aiocsv import AsyncDictReader
+from boto3.dynamodb.types import TypeSerializer
+from botocore.config import Config
 from botocore.exceptions import ClientError, ParamValidationError
 
+try:
+    import uvloop
+except ImportError:  # optional, and not available on windows
+    uvloop = None
+
 # keep these constants
 AWS_REGION = 'us-west-2'
 TABLE_NAME: str = 'lms_assignments'
 POS_INT_REGX: str = r'^\d+$'
+CSV_BUFFER_SIZE: int = 1 << 20  # 1 MiB reads instead of the default 8 KiB
+CSV_CHUNKS: int = 4 * (os.cpu_count() or 1)
+PARSE_BATCH_ROWS: int = 200  # rows each range parses per executor call before queueing their items
+CSV_COLUMNS: tuple[str, ...] = (  # the columns build_item reads, in the order it unpacks them
+    'Username', 'ActivityIDSource', 'SourceIDEmpPk', 'LocalEmployeeID', 'EmpFullName1', 'FirstName', 'LastName',
+    'UserPrimaryOrganizationCode', 'ManagerLocalEmployeeID', 'ActivityCode', 'ActivityName', 'AssignmentStatus',
+    'UCRequirementStatus', 'PlanDate', 'DueDate', 'ExpirationDate', 'AttemptEndDate', 'LastCompletionDateRealtime'
+)
+MAX_ITEMS: int = 5000  # no need to load all 180k for method comparison
 ERROR_HELP_STRINGS = {
     # Operation specific errors
     'ConditionalCheckFailedException':          'Condition check specified in the operation failed,'
@@ -52,11 +67,33 @@ ERROR_HELP_STRINGS = {
                                                 ' increase account level throughput before retrying',
 }
 
+# write settings
+SERIALIZER = TypeSerializer()  # shared, items are marshalled once in build_item for the low-level client
+BATCH_SIZE: int = 25  # most requests allowed in a single BatchWriteItem call
+# most items written at once, about provisioned WCU / item size in KB, WRITERS rounds it down to whole batches
+MAX_IN_FLIGHT_PUTS: int = 64
+WRITERS: int = max(1, MAX_IN_FLIGHT_PUTS // BATCH_SIZE)  # each writer has one BATCH_SIZE call in flight
+WRITE_QUEUE_SIZE: int = 500  # built items waiting to be put, with the parse batches this bounds memory
+
+# retry settings, botocore retries each request first and write_batch retries what it gives up on
+RETRYABLE_ERROR_CODES = {'ProvisionedThroughputExceededException', 'ThrottlingException', 'InternalServerError'}
+BACKOFF_BASE: float = 0.05  # seconds
+BACKOFF_CAP: float = 20.0  # seconds
+BACKOFF_JITTER: float = 0.1  # seconds
+BACKOFF_MAX_ATTEMPTS: int = 10
+
+# a pooled keep-alive connection for every writer, never fewer than botocore's default of 10
+BOTO_CONFIG = Config(
+    max_pool_connections=max(WRITERS, 10),
+    tcp_keepalive=True,
+    retries={'max_attempts': 20, 'mode': 'adaptive'}
+)
+
 # these constants are for running this on a dev host
 HOME_DIR = os.path.abspath(os.path.join(os.path.realpath(__file__), os.pardir))
 RESULT_DIR = f'{HOME_DIR}/results/'
 
-global args, dynamodb, logger
+global args, dynamodb, items_queued, items_written, logger
 
 
 #  functions
@@ -98,16 +135,19 @@ def parse_arguments() -> Namespace:
 def convert_date(date: str) -> str:
     if date is None or date == '':
         return ''
-    else:
-        return dt.datetime.strptime(date, '%m/%d/%y').isoformat()
-
 
-def convert_nullable(value: str) -> str:
-    return value if value is not None and value != '' else 'null'
-
-
-def convert_orgcode(code: str) -> str:
-    return code.replace('01HD', '')
+    # hand-parsed equivalent of strptime(date, '%m/%d/%y'), which is slow to run for every date column
+    month, day, year = date.split('/')
+    if len(day) == 2 and day[0] == ' ':  # %d also accepts a space padded day
+        day = day[1]
+    # like strptime, month and day digits are ascii except the second of a 1x or 2x day, %y takes any two digits
+    if not (month.isascii() and month.isdecimal() and len(month) <= 2
+            and day.isdecimal() and len(day) <= 2 and (day.isascii() or day[0] in '12')
+            and year.isdecimal() and len(year) == 2):
+        raise ValueError(f'date {date!r} does not match format MM/DD/YY')
+    year = int(year)
+    year += 2000 if year < 69 else 1900  # same two digit year pivot as %y
+    return dt.datetime(year, int(month), int(day)).isoformat()
 
 
 def log_boto_client_error(error) -> None:
@@ -116,34 +156,41 @@ def log_boto_client_error(error) -> None:
     logger.exception('[%s] %s.\n\tError message: %s', error_code, error_help_string, error.response['Error']['Message'])
 
 
-def build_item(given: dict) -> dict:
+def build_item(given: tuple[str, ...], now_iso: str) -> dict:
     global logger
     item: dict = None
 
-    if re.fullmatch(POS_INT_REGX, given['Username']):  # only process items representing persons
+    (username, activity_id, calnet_uid, empl_id, full_name, given_name, family_name, org_code, manager_empl_id,
+     activity_code, activity_name, assignment_status, requirement_status, plan_date, due_date, expiration_date,
+     attempt_end_date, last_completion_date) = given
+
+    # only process items representing persons, same test as POS_INT_REGX without the regex engine
+    if username.isdecimal():
         try:
+            # a literal with constant keys is built presized in one step, faster than dict(zip(keys, values))
             item = {
-                "lms_user_id": int(given['Username']),
-                "activity_id": int(given['ActivityIDSource']),
-                "calnet_uid": given['SourceIDEmpPk'],
-                "empl_id": convert_nullable(given['LocalEmployeeID']),
-                "full_name": given['EmpFullName1'],
-                "given_name": given['FirstName'],
-                "family_name": given['LastName'],
-                "empl_org_code": convert_orgcode(given['UserPrimaryOrganizationCode']),
-                "manager_empl_id": convert_nullable(given['ManagerLocalEmployeeID']),
-                "activity_code": given['ActivityCode'],
-                "activity_name": given['ActivityName'],
-                "is_required": bool(given['AssignmentStatus'] == 'Required'),
-                "assignment_status": given['UCRequirementStatus'],
-                "assigned_date": convert_date(given['PlanDate']),
-                "due_date": convert_date(given['DueDate']),
-                "expiration_date": convert_date(given['ExpirationDate']),
-                "last_attempt_date": convert_date(given['AttemptEndDate']),
-                "last_completion_date": convert_date(given['LastCompletionDateRealtime']),
-                "last_updated_datetime": dt.datetime.now().isoformat(timespec='seconds'),
+                "lms_user_id": int(username),
+                "activity_id": int(activity_id),
+                "calnet_uid": calnet_uid,
+                "empl_id": empl_id or 'null',
+                "full_name": full_name,
+                "given_name": given_name,
+                "family_name": family_name,
+                "empl_org_code": org_code.replace('01HD', ''),
+                "manager_empl_id": manager_empl_id or 'null',
+                "activity_code": activity_code,
+                "activity_name": activity_name,
+                "is_required": assignment_status == 'Required',
+                "assignment_status": requirement_status,
+                "assigned_date": convert_date(plan_date),
+                "due_date": convert_date(due_date),
+                "expiration_date": convert_date(expiration_date),
+                "last_attempt_date": convert_date(attempt_end_date),
+                "last_completion_date": convert_date(last_completion_date),
+                "last_updated_datetime": now_iso,
                 "last_updated_event_id": 0
             }
+            item = {key: SERIALIZER.serialize(value) for key, value in item.items()}
 
         except Exception as e:
             logger.debug('Exception while building item: %s', e)
@@ -152,47 +199,192 @@ def build_item(given: dict) -> dict:
     return item
 
 
+async def write_batch(client, requests: list[dict]) -> None:
+    global items_written, logger
+    attempt: int = 0
+
+    while True:
+        try:
+            response = await client.batch_write_item(RequestItems={TABLE_NAME: requests})
+            unprocessed = response.get('UnprocessedItems', {}).get(TABLE_NAME, [])
+            items_written += len(requests) - len(unprocessed)  # only count what DynamoDB accepted
+            requests = unprocessed
+            if not requests:
+                return
+            reason = f'{len(requests)} unprocessed items'
+
+        except ClientError as e:
+            error_code = e.response['Error']['Code']
+            if error_code not in RETRYABLE_ERROR_CODES or attempt >= BACKOFF_MAX_ATTEMPTS:
+                raise e
+            reason = error_code
+
+        if attempt >= BACKOFF_MAX_ATTEMPTS:
+            logger.error('Dropped %s unprocessed items after %s attempts', len(requests), attempt)
+            return
+
+        delay = min(BACKOFF_CAP, BACKOFF_BASE * 2 ** attempt) + random.random() * BACKOFF_JITTER
+        attempt += 1
+        logger.warning('[%s] Retrying batch write in %.2fs (attempt %s of %s)',
+                       reason, delay, attempt, BACKOFF_MAX_ATTEMPTS)
+        await asyncio.sleep(delay)
+
+
+def read_header(path: str) -> tuple[list[str], int]:
+    """
+    Returns the csv column names and the byte offset where the data rows begin
+    :return: tuple
+    """
+    with open(path, mode='rb') as f:
+        line = f.readline()
+
+    return next(csv.reader([line.decode('utf-8', errors='replace')]), []), len(line)
+
+
+def split_range(start: int, end: int, count: int) -> list[tuple[int, int]]:
+    step = max(1, -(-(end - start) // count))
+    return [(offset, min(offset + step, end)) for offset in range(start, end, step)]
+
+
+def read_lines(path: str, start: int, end: int) -> Iterator[str]:
+    """
+    Yields every line of the file that begins within the byte range [start, end)
+    :return: Iterator
+    """
+    with open(path, mode='rb', buffering=CSV_BUFFER_SIZE) as f:
+        position: int = start
+
+        # back up a byte and skip to the next line start, the previous range owns the partial line
+        if start > 0:
+            f.seek(start - 1)
+            position = start - 1 + len(f.readline())
+
+        while position < end:
+            line = f.readline()
+            if not line:
+                break
+            position += len(line)
+            yield line.decode('utf-8', errors='replace')
+
+
+def parse_rows(reader: Iterator[list[str]], columns: operator.itemgetter, now_iso: str) -> tuple[list[dict], bool]:
+    """
+    Returns the items built from the next PARSE_BATCH_ROWS rows of the reader and whether it may have more,
+    run in a worker thread to keep the event loop free
+    :return: tuple
+    """
+    global logger
+    items: list[dict] = []
+    rows: int = 0
+
+    for this in itertools.islice(reader, PARSE_BATCH_ROWS):
+        rows += 1
+
+        if not this:  # blank line
+            continue
+
+        try:
+            item = build_item(columns(this), now_iso)
+            if item:
+                items.append(item)
+
+        except (IndexError, ValueError) as e:  # short row or unconvertible value
+            logger.exception('Invalid value while building item: %s\n%s', this, e)
+
+    return items, rows == PARSE_BATCH_ROWS
+
+
+async def read_range(queue: asyncio.Queue, columns: operator.itemgetter, start: int, end: int,
+                     now_iso: str) -> None:
+    global items_queued, logger
+    loop = asyncio.get_running_loop()
+    debug_on: bool = logger.isEnabledFor(logging.DEBUG)
+    more: bool = True
+
+    reader = csv.reader(read_lines(args.file, start, end))
+
+    # parse a batch of rows at a time so the writers start on the first ones while the rest are read,
+    # no need to load all 180k for method comparison
+    while more and items_queued < MAX_ITEMS:
+        items, more = await loop.run_in_executor(None, parse_rows, reader, columns, now_iso)
+
+        for item in items:
+            if items_queued >= MAX_ITEMS:
+                break
+
+            items_queued += 1  # count before awaiting so other ranges see it
+            await queue.put(item)
+
+            if debug_on and items_queued % 1000 == 0:
+                logger.debug('Queued %s items, written %s', items_queued, items_written)
+
+
+async def write_items(queue: asyncio.Queue, client) -> None:
+    global logger
+    batch: list[dict] = []
+    done: bool = False
+
+    while not done:
+        item = await queue.get()
+        if item is None:
+            done = True
+        else:
+            batch.append({'PutRequest': {'Item': item}})
+
+        if len(batch) == BATCH_SIZE or (done and batch):
+            try:
+                await write_batch(client, batch)
+            except ParamValidationError as e:
+                logger.exception('Invalid parameter while writing batch: %s\n%s', batch, e)
+            batch = []
+
+
 async def load_from_csv() -> int:
-    global dynamodb, logger
-    item_count: int = 0
+    global dynamodb, items_queued, items_written, logger
+    items_queued = 0
+    items_written = 0
 
-    table = await dynamodb.Table(TABLE_NAME)
+    now_iso = time.strftime('%Y-%m-%dT%H:%M:%S')  # local time, same format as isoformat(timespec='seconds')
+    queue: asyncio.Queue = asyncio.Queue(maxsize=WRITE_QUEUE_SIZE)
 
-    async with aiofiles.open(args.file, mode='r', encoding='utf-8', errors='replace') as f:
-        reader: AsyncDictReader[str] = AsyncDictReader(f)
+    fieldnames, data_start = read_header(args.file)
+    missing = [name for name in CSV_COLUMNS if name not in fieldnames]
+    if missing:
+        logger.error('CSV file (%s) is missing columns: %s', args.file, ', '.join(missing))
+        return items_written
 
-        async with table.batch_writer() as writer:
-            writes = []
+    # pull the build_item columns out of each row by position in a single call
+    columns = operator.itemgetter(*[fieldnames.index(name) for name in CSV_COLUMNS])
 
-            async for this in reader:
-                try:
-                    item = build_item(this)
-                    if item:
-                        future = asyncio.ensure_future(writer.put_item(Item=item))
-                        writes.append(future)
-                        item_count += 1
-                        await asyncio.gather(*writes)
+    # split the rows into byte ranges that are parsed side by side in the default executor
+    ranges = split_range(data_start, os.stat(args.file).st_size, CSV_CHUNKS)
 
-                    if item_count % 100 == 0:
-                        logger.debug('Loaded %s items', item_count)
+    # the readers fill the bounded queue while the writers drain it, so parsing overlaps the puts
+    readers = [asyncio.create_task(read_range(queue, columns, start, end, now_iso)) for start, end in ranges]
+    writers = [asyncio.create_task(write_items(queue, dynamodb)) for _ in range(WRITERS)]
 
-                    # no need to load all 180k for method comparison
-                    if item_count == 5000:
-                        item_count = item_count
-                        break
+    async def stop_writers() -> None:
+        await asyncio.gather(*readers)
+        for _ in writers:
+            await queue.put(None)  # one stop sentinel per writer
 
-                except ValueError as e:
-                    logger.exception('Invalid value while putting item: %s\n%s', item, e)
-                except ParamValidationError as e:
-                    logger.exception('Invalid parameter while putting item: %s\n%s', item, e)
-                except ClientError as e:
-                    log_boto_client_error(e)
-                    return item_count
-                except Exception as e:
-                    logger.exception('Unknown error during load_from_csv: %s', e)
-                    return item_count
+    tasks = readers + writers + [asyncio.create_task(stop_writers())]
 
-    return item_count
+    try:
+        await asyncio.gather(*tasks)
+    except ClientError as e:
+        log_boto_client_error(e)
+    except Exception:
+        # anything else, such as a csv.Error from a range, ends the load and is reported by main
+        logger.error('Stopped loading after writing %s items', items_written)
+        raise
+    finally:
+        # on an error stop every reader and writer, and wait until they have unwound before returning
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    return items_written
 
 
 async def main() -> None:
@@ -223,17 +415,17 @@ async def main() -> None:
     # begin
     start_time = time.time()
     logger.info('Started')
+    item_count: int = 0
 
     try:
         # create a durable aws session
-        stack = contextlib.AsyncExitStack()
         data_session = aioboto3.Session(
             aws_access_key_id=os.environ['AWS_ACCESS_KEY_ID'],
             aws_secret_access_key=os.environ['AWS_SECRET_ACCESS_KEY'],
             aws_session_token=os.environ['AWS_SESSION_TOKEN']
         )
-        async with data_session.resource('dynamodb', region_name=AWS_REGION) as dynamodb:
-            item_count: int = await load_from_csv()
+        async with data_session.client('dynamodb', region_name=AWS_REGION, config=BOTO_CONFIG) as dynamodb:
+            item_count = await load_from_csv()
 
     except FileNotFoundError as e:
         logger.exception('Unable to find specified file (%s): %s', args.file, e)
@@ -246,11 +438,12 @@ async def main() -> None:
     except Exception as e:
         logger.exception('Unknown problem: %s', e)
 
-    await stack.aclose()
-
     logger.info('Loaded %s items in %s', item_count, dt.timedelta(seconds=time.time()-start_time))
 
 
 # main
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    if uvloop is not None:
+        uvloop.run(main())  # lower per await overhead than the default event loop
+    else:
+        asyncio.run(main())
\ No newline at end of file